@@ -5,16 +5,24 @@ Provides endpoints for invoice analysis and chatbot interaction.
 from fastapi import FastAPI, File, UploadFile, Form, Request  # FastAPI core imports
 from fastapi.responses import JSONResponse  # For custom JSON responses
 from fastapi.middleware.cors import CORSMiddleware  # To enable CORS for frontend/backend communication
-from utils import extract_pdf_text, extract_invoices_from_zip, analyze_invoice_with_gemini, answer_query_with_gemini  # Utility functions
-from vector_store import add_invoice_analysis_to_vector_db, search_invoices, extract_metadata_filters  # Vector DB and search
+from utils import extract_pdf_text, extract_invoices_from_zip, analyze_invoice_with_gemini, answer_query_with_gemini, submit_invoice_batch, get_invoice_batch_results, save_batch_job, get_batch_job, claim_batch_job, create_policy_cache, delete_policy_cache, BATCH_MIN_INVOICES, BATCH_DONE_STATES, analysis_cache_key, get_cached_analysis, cache_analysis  # Utility functions
+from vector_store import add_invoice_analysis_to_vector_db, search_invoices, extract_metadata_filters, get_cached_reply, cache_reply  # Vector DB and search
 from datetime import date  # For timestamping analyses
 import json
 import re
+import asyncio  # To keep blocking work off the event loop
+from concurrent.futures import ThreadPoolExecutor  # Dedicated threads for per-invoice Gemini calls
 from pydantic import BaseModel  # For request validation
-from concurrent.futures import ThreadPoolExecutor, as_completed  # For parallel processing
 
 app = FastAPI()
 
+# Markdown code fences that Gemini sometimes wraps around its JSON output
+_FENCE_RE = re.compile(r"^```(?:json)?|```$", re.MULTILINE)
+# Per-invoice Gemini calls run on their own bounded pool, so a large upload cannot occupy the
+# event loop's default executor that /chatbot and the other blocking helpers share
+LLM_WORKERS = 8
+_llm_executor = ThreadPoolExecutor(max_workers=LLM_WORKERS, thread_name_prefix="gemini")
+
 # Enable CORS for all origins (for development/testing)
 app.add_middleware(
     CORSMiddleware,
@@ -28,15 +36,32 @@ class ChatbotRequest(BaseModel):
     """Request model for chatbot endpoint."""
     message: str
 
-def process_invoice(policy_text, fname, text, employee_name):
-    """Helper function to analyze a single invoice (for threading)."""
+def upload_stream(upload):
+    """
+    Returns a file object for an upload that zipfile and PDFium can read from directly.
+    Before Python 3.11, SpooledTemporaryFile lacks seekable() and readinto(), so its underlying
+    (already spooled) BytesIO or temporary file is used instead.
+    """
+    f = upload.file
+    return f if hasattr(f, "seekable") else f._file
+
+def process_invoice(policy_text, fname, text, employee_name, policy_cache=None):
+    """Helper function to analyze a single invoice (run in a worker thread)."""
     if text.startswith("[ERROR"):
         return {"invoice_id": fname, "error": text}
-    analysis = analyze_invoice_with_gemini(policy_text, text, employee_name)
+    analysis = analyze_invoice_with_gemini(policy_text, text, employee_name, policy_cache=policy_cache)
+    return parse_invoice_analysis(fname, text, analysis, employee_name)
+
+def parse_invoice_analysis(fname, text, analysis, employee_name):
+    """Turns a raw LLM analysis response into an analysis dict (or an error dict)."""
     if analysis.startswith("[ERROR"):
         return {"invoice_id": fname, "error": analysis}
     try:
-        cleaned = re.sub(r"^```(?:json)?|```$", "", analysis, flags=re.MULTILINE).strip()
+        # Only run the regex when the response is actually wrapped in a code fence
+        if analysis.lstrip().startswith("```"):
+            cleaned = _FENCE_RE.sub("", analysis).strip()
+        else:
+            cleaned = analysis.strip()
         analysis_json = json.loads(cleaned)
         return {
             "invoice_id": fname,
@@ -49,6 +74,43 @@ def process_invoice(policy_text, fname, text, employee_name):
     except Exception as e:
         return {"invoice_id": fname, "error": f"Failed to parse LLM output: {e}"}
 
+def lookup_cached_analyses(policy_text, invoice_texts, employee_name):
+    """
+    Splits invoices into exact-duplicate analyses served from the content-hash cache and ones still to analyze.
+    Returns (cached analysis dicts, dict of pending filename to text, dict of filename to cache key).
+    """
+    cache_keys = {fname: analysis_cache_key(policy_text, text, employee_name) for fname, text in invoice_texts.items()}
+    cached, pending = [], {}
+    for fname, text in invoice_texts.items():
+        hit = get_cached_analysis(cache_keys[fname])
+        if hit is None:
+            pending[fname] = text
+        else:
+            cached.append({"invoice_id": fname, **hit, "date": str(date.today()), "full_text": text})
+    return cached, pending, cache_keys
+
+def store_cached_analyses(analyses, cache_keys):
+    """Records successful analyses in the content-hash cache."""
+    for analysis in analyses:
+        if not analysis.get("error"):
+            cache_analysis(cache_keys[analysis["invoice_id"]], analysis)
+
+async def analyze_pending_invoices(policy_text, pending, employee_name):
+    """Analyzes invoices with concurrent per-invoice Gemini calls on the dedicated LLM executor."""
+    # Tokenize the policy once and share the cached prefix across invoices; a single invoice has
+    # nothing to share it with, so it sends the policy inline
+    policy_cache = None
+    if len(pending) > 1:
+        policy_cache = await asyncio.to_thread(create_policy_cache, policy_text)
+    loop = asyncio.get_running_loop()
+    try:
+        return await asyncio.gather(*[
+            loop.run_in_executor(_llm_executor, process_invoice, policy_text, fname, text, employee_name, policy_cache)
+            for fname, text in pending.items()
+        ])
+    finally:
+        await asyncio.to_thread(delete_policy_cache, policy_cache)
+
 @app.post("/analyze_invoices")
 async def analyze_invoices(
     policy_pdf: UploadFile = File(...),
@@ -58,41 +120,99 @@ async def analyze_invoices(
     """
     Analyze a batch of invoice PDFs against a policy PDF for a given employee.
     Stores successful analyses in the vector database.
-    Uses multi-threading for efficient batch processing.
+    ZIPs with at least BATCH_MIN_INVOICES new invoices are submitted as one Gemini batch job and the
+    response carries its name in "batch_job"; poll GET /analyze_invoices/batch/{batch_job} for those
+    invoices. Smaller ZIPs use concurrent per-invoice calls.
+    Blocking PDF parsing and LLM calls run in worker threads so the event loop keeps serving requests;
+    per-invoice Gemini calls use their own bounded pool (LLM_WORKERS) rather than the default executor.
     """
     try:
-        # Parse and extract text from the uploaded policy PDF
-        policy_bytes = await policy_pdf.read()
-        policy_text = extract_pdf_text(policy_bytes)
+        # Parse and extract text from the uploaded policy PDF, reading straight from the spooled upload
+        policy_text = await asyncio.to_thread(extract_pdf_text, upload_stream(policy_pdf))
         if policy_text.startswith("[ERROR"):
             return JSONResponse(status_code=400, content={"success": False, "error": policy_text})
 
-        # Parse ZIP and extract invoice PDFs as text
-        zip_bytes = await invoices_zip.read()
-        invoice_texts = extract_invoices_from_zip(zip_bytes)
+        # Parse ZIP and extract invoice PDFs as text, streaming entries from the spooled upload
+        invoice_texts = await asyncio.to_thread(extract_invoices_from_zip, upload_stream(invoices_zip))
         if any(fname.startswith("[ZIP ERROR]") for fname in invoice_texts):
             return JSONResponse(status_code=400, content={"success": False, "error": invoice_texts})
 
-        analyses = []
-        # Use ThreadPoolExecutor to process invoices in parallel
-        with ThreadPoolExecutor() as executor:
-            futures = [
-                executor.submit(process_invoice, policy_text, fname, text, employee_name)
-                for fname, text in invoice_texts.items()
-            ]
-            for future in as_completed(futures):
-                analyses.append(future.result())
+        # Invoices that failed extraction never reach the LLM
+        analyses = [
+            {"invoice_id": fname, "error": text}
+            for fname, text in invoice_texts.items() if text.startswith("[ERROR")
+        ]
+        extracted = {fname: text for fname, text in invoice_texts.items() if not text.startswith("[ERROR")}
+        # Exact duplicates of earlier analyses are served from the content-hash cache
+        cached, pending, cache_keys = await asyncio.to_thread(lookup_cached_analyses, policy_text, extracted, employee_name)
+        analyses.extend(cached)
+
+        batch_job = None
+        if len(pending) >= BATCH_MIN_INVOICES:
+            # Large ZIPs go out as one inline batch job, collected later via the batch endpoint
+            batch_job = await asyncio.to_thread(submit_invoice_batch, policy_text, pending, employee_name)
+        if batch_job is not None:
+            await asyncio.to_thread(save_batch_job, batch_job, {
+                "policy_text": policy_text,
+                "employee_name": employee_name,
+                "invoices": pending,
+                "cache_keys": {fname: cache_keys[fname] for fname in pending},
+            })
+        elif pending:
+            # Small ZIP or batch submission failed: analyze invoices concurrently on the LLM executor
+            fresh = await analyze_pending_invoices(policy_text, pending, employee_name)
+            await asyncio.to_thread(store_cached_analyses, fresh, cache_keys)
+            analyses.extend(fresh)
 
         # Store only successful analyses in the vector DB
         successful_analyses = [a for a in analyses if not a.get("error")]
         if successful_analyses:
-            add_invoice_analysis_to_vector_db(successful_analyses)
+            await asyncio.to_thread(add_invoice_analysis_to_vector_db, successful_analyses)
 
+        if batch_job is not None:
+            return JSONResponse(status_code=202, content={
+                "success": True, "analyses": analyses, "batch_job": batch_job, "pending": list(pending)
+            })
         return {"success": True, "analyses": analyses}
     except Exception as e:
         # Catch-all error handler
         return JSONResponse(status_code=500, content={"success": False, "error": str(e)})
 
+@app.get("/analyze_invoices/batch/{job_name:path}")
+async def analyze_invoices_batch_results(job_name: str):
+    """
+    Collects the analyses of a batch job submitted by /analyze_invoices.
+    Returns done=False while the job runs. Once it finishes, the analyses are parsed, stored in the
+    vector database and returned; a job that failed, expired or was cancelled is re-run with
+    per-invoice calls instead, so every submitted invoice is eventually analyzed.
+    """
+    try:
+        job = await asyncio.to_thread(get_batch_job, job_name)
+        if job is None:
+            return JSONResponse(status_code=404, content={"success": False, "error": f"Unknown or already collected batch job: {job_name}"})
+        pending, employee_name = job["invoices"], job["employee_name"]
+        state, responses = await asyncio.to_thread(get_invoice_batch_results, job_name, list(pending))
+        if state not in BATCH_DONE_STATES:
+            return {"success": True, "done": False, "state": state}
+        # Only one poller stores the results
+        if not await asyncio.to_thread(claim_batch_job, job_name):
+            return JSONResponse(status_code=404, content={"success": False, "error": f"Unknown or already collected batch job: {job_name}"})
+        if responses is not None:
+            analyses = [
+                parse_invoice_analysis(fname, text, responses[fname], employee_name)
+                for fname, text in pending.items()
+            ]
+        else:
+            analyses = await analyze_pending_invoices(job["policy_text"], pending, employee_name)
+        await asyncio.to_thread(store_cached_analyses, analyses, job["cache_keys"])
+        successful_analyses = [a for a in analyses if not a.get("error")]
+        if successful_analyses:
+            await asyncio.to_thread(add_invoice_analysis_to_vector_db, successful_analyses)
+        return {"success": True, "done": True, "state": state, "analyses": analyses}
+    except Exception as e:
+        # Catch-all error handler
+        return JSONResponse(status_code=500, content={"success": False, "error": str(e)})
+
 @app.post("/chatbot")
 async def chatbot_endpoint(request: ChatbotRequest):
     """
@@ -104,10 +224,15 @@ async def chatbot_endpoint(request: ChatbotRequest):
         return JSONResponse(status_code=400, content={"success": False, "error": "No message provided."})
     # Extract metadata filters from the query
     filters = extract_metadata_filters(message)
+    # Serve semantically repeated questions from the cache
+    reply = await asyncio.to_thread(get_cached_reply, message, filters)
+    if reply is not None:
+        return {"success": True, "response": reply}
     # Perform filtered similarity search
-    results = search_invoices(message, top_k=15, filters=filters)
+    results = await asyncio.to_thread(search_invoices, message, top_k=15, filters=filters)
     if not results:
         reply = "No matching invoices found. Please try a different query."
     else:
-        reply = answer_query_with_gemini(message, results)
+        reply = await asyncio.to_thread(answer_query_with_gemini, message, results)
+        await asyncio.to_thread(cache_reply, message, reply, filters)
     return {"success": True, "response": reply} 
\ No newline at end of file
@@ -0,0 +1,88 @@
+"""
+Embedding model for the Invoice Reimbursement System.
+Runs all-MiniLM-L6-v2 as a dynamically int8-quantized ONNX model on ONNX Runtime,
+exposing the subset of the SentenceTransformer.encode API used by the vector store.
+"""
+import numpy as np
+from optimum.onnxruntime import ORTModelForFeatureExtraction  # ONNX Runtime model wrapper
+from onnxruntime.quantization import quantize_dynamic, QuantType  # Post-training int8 quantization
+from transformers import AutoTokenizer
+import logging
+import os
+import shutil
+import tempfile
+
+EMBEDDING_MODEL_ID = "sentence-transformers/all-MiniLM-L6-v2"
+# Exported and quantized model files are cached here on first use
+ONNX_MODEL_DIR = os.path.join(os.path.dirname(__file__), "onnx_model")
+ONNX_INT8_FILE = "model_int8.onnx"
+MAX_SEQ_LENGTH = 256  # Same truncation as the sentence-transformers model card
+
+def _export_quantized_model(model_dir):
+    """
+    One-time export of MiniLM to ONNX followed by dynamic int8 weight quantization.
+    The files are built in a private temp directory and renamed into place, so processes exporting
+    at the same time (e.g. the API and Streamlit on first start) never see or leave a partial model.
+    """
+    logging.info(f"Exporting {EMBEDDING_MODEL_ID} to int8 ONNX in {model_dir}")
+    parent = os.path.dirname(os.path.abspath(model_dir))
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=os.path.basename(model_dir) + ".", suffix=".tmp", dir=parent)
+    try:
+        model = ORTModelForFeatureExtraction.from_pretrained(EMBEDDING_MODEL_ID, export=True)
+        model.save_pretrained(tmp_dir)
+        AutoTokenizer.from_pretrained(EMBEDDING_MODEL_ID).save_pretrained(tmp_dir)
+        quantize_dynamic(
+            os.path.join(tmp_dir, "model.onnx"),
+            os.path.join(tmp_dir, ONNX_INT8_FILE),
+            weight_type=QuantType.QInt8,
+        )
+        try:
+            os.replace(tmp_dir, model_dir)
+        except OSError:
+            # Either another process finished first (keep its copy), or model_dir holds a partial
+            # export left by an interrupted run, which is replaced
+            if not os.path.exists(os.path.join(model_dir, ONNX_INT8_FILE)):
+                shutil.rmtree(model_dir, ignore_errors=True)
+                os.replace(tmp_dir, model_dir)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+class QuantizedEmbeddingModel:
+    """Drop-in replacement for SentenceTransformer("all-MiniLM-L6-v2") backed by int8 ONNX Runtime."""
+
+    def __init__(self, model_dir=ONNX_MODEL_DIR):
+        if not os.path.exists(os.path.join(model_dir, ONNX_INT8_FILE)):
+            _export_quantized_model(model_dir)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            model_dir, file_name=ONNX_INT8_FILE, provider="CPUExecutionProvider"
+        )
+
+    def encode(self, sentences, batch_size=32, convert_to_numpy=True, normalize_embeddings=False, show_progress_bar=False):
+        """
+        Embeds a string or list of strings with mean pooling over token embeddings.
+        Returns a float32 array of shape (384,) for a single string or (N, 384) for a list.
+        convert_to_numpy and show_progress_bar are accepted for API compatibility; output is always numpy.
+        """
+        single = isinstance(sentences, str)
+        if single:
+            sentences = [sentences]
+        batches = []
+        for start in range(0, len(sentences), batch_size):
+            inputs = self.tokenizer(
+                sentences[start:start + batch_size],
+                padding=True,
+                truncation=True,
+                max_length=MAX_SEQ_LENGTH,
+                return_tensors="np",
+            )
+            token_embeddings = self.model(**inputs).last_hidden_state
+            # Mean-pool over real (non-padding) tokens
+            mask = inputs["attention_mask"][..., np.newaxis].astype('float32')
+            pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            if normalize_embeddings:
+                pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            batches.append(pooled.astype('float32'))
+        embeddings = np.vstack(batches) if batches else np.empty((0, self.model.config.hidden_size), dtype='float32')
+        return embeddings[0] if single else embeddings
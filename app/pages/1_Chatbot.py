@@ -2,7 +2,7 @@
 Chatbot page for the Invoice Reimbursement System multipage app.
 """
 import streamlit as st
-from vector_store import search_invoices, extract_metadata_filters
+from vector_store import search_invoices, extract_metadata_filters, get_cached_reply, cache_reply
 from utils import answer_query_with_gemini
 
 st.title("Invoice Reimbursement Chatbot")  # Page title
@@ -23,16 +23,24 @@ if prompt := st.chat_input("Type your query about invoice reimbursements..."):
     with st.chat_message("user"):
         st.markdown(prompt)
     # Process the user's query and generate assistant response
-    with st.spinner("Searching and generating answer..."):
+    results = None
+    with st.spinner("Searching..."):
         # Extract metadata filters from the query
         filters = extract_metadata_filters(prompt)
-        # Perform filtered similarity search
-        results = search_invoices(prompt, top_k=15, filters=filters)
-        if not results:
-            assistant_reply = "No matching invoices found. Please try a different query."
-        else:
-            assistant_reply = answer_query_with_gemini(prompt, results)
+        # Serve semantically repeated questions from the cache
+        assistant_reply = get_cached_reply(prompt, filters)
+        if assistant_reply is None:
+            # Perform filtered similarity search
+            results = search_invoices(prompt, top_k=15, filters=filters)
+            if not results:
+                assistant_reply = "No matching invoices found. Please try a different query."
     # Display assistant's reply and add to chat history
     with st.chat_message("assistant"):
-        st.markdown(assistant_reply)
-    st.session_state["messages"].append({"role": "assistant", "content": assistant_reply}) 
\ No newline at end of file
+        if assistant_reply is None:
+            # Render the answer as Gemini generates it instead of waiting for the full response
+            assistant_reply = st.write_stream(answer_query_with_gemini(prompt, results, stream=True))
+            if "[ERROR" not in assistant_reply:
+                cache_reply(prompt, assistant_reply, filters)
+        else:
+            st.markdown(assistant_reply)
+    st.session_state["messages"].append({"role": "assistant", "content": assistant_reply})
\ No newline at end of file
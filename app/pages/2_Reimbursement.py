@@ -2,12 +2,15 @@
 Reimbursement page for the Invoice Reimbursement System multipage app.
 """
 import streamlit as st
-from utils import extract_pdf_text, extract_invoices_from_zip, analyze_invoice_with_gemini
+from utils import extract_pdf_text, extract_invoices_from_zip, analyze_invoice_with_gemini, create_policy_cache, delete_policy_cache, analysis_cache_key, get_cached_analysis, cache_analysis
 from vector_store import add_invoice_analysis_to_vector_db
 import json
 from datetime import date
 import re
 
+# Markdown code fences that Gemini sometimes wraps around its JSON output
+_FENCE_RE = re.compile(r"^```(?:json)?|```$", re.MULTILINE)
+
 st.title("Invoice Reimbursement Application")  # Page title
 
 policy_pdf = st.file_uploader("Upload HR Reimbursement Policy (PDF)", type=["pdf"])
@@ -33,31 +36,58 @@ if st.button("Submit"):
 
         st.subheader(f"LLM Analysis for {len(invoice_texts)} Invoice(s)")
         analyses = []
-        for fname, text in invoice_texts.items():
-            if text.startswith("[ERROR"):
-                st.error(f"{fname}: {text}")
-                continue
-            with st.spinner(f"Analyzing {fname} with Gemini..."):
-                analysis = analyze_invoice_with_gemini(policy_text, text, employee_name)
-            if analysis.startswith("[ERROR"):
-                st.error(f"{fname}: {analysis}")
-            else:
-                st.markdown(f"**{fname}:**")
-                st.code(analysis, language="json")
-                try:
-                    # Remove markdown code block formatting if present
-                    cleaned = re.sub(r"^```(?:json)?|```$", "", analysis, flags=re.MULTILINE).strip()
-                    analysis_json = json.loads(cleaned)
-                    analyses.append({
-                        "invoice_id": fname,
-                        "status": analysis_json.get("status", ""),
-                        "reason": analysis_json.get("reason", ""),
-                        "employee_name": analysis_json.get("employee_name", employee_name),
-                        "date": str(date.today()),
-                        "full_text": text
-                    })
-                except Exception as e:
-                    st.error(f"Failed to parse LLM output for {fname}: {e}")
+        # Exact duplicates of earlier analyses skip the LLM call
+        cache_keys = {
+            fname: analysis_cache_key(policy_text, text, employee_name)
+            for fname, text in invoice_texts.items() if not text.startswith("[ERROR")
+        }
+        cached_analyses = {fname: get_cached_analysis(cache_key) for fname, cache_key in cache_keys.items()}
+        misses = sum(cached is None for cached in cached_analyses.values())
+        # Tokenize the policy once and share the cached prefix across invoices; only worth it when
+        # more than one invoice goes to Gemini, otherwise the policy is sent inline
+        policy_cache = None
+        try:
+            for fname, text in invoice_texts.items():
+                if text.startswith("[ERROR"):
+                    st.error(f"{fname}: {text}")
+                    continue
+                cache_key = cache_keys[fname]
+                cached = cached_analyses[fname]
+                if cached is not None:
+                    st.markdown(f"**{fname}:** (cached)")
+                    st.code(json.dumps(cached, indent=2), language="json")
+                    analyses.append({"invoice_id": fname, **cached, "date": str(date.today()), "full_text": text})
+                    continue
+                if misses > 1:
+                    policy_cache = create_policy_cache(policy_text)
+                    misses = 0  # Created once, on the first miss
+                with st.spinner(f"Analyzing {fname} with Gemini..."):
+                    analysis = analyze_invoice_with_gemini(policy_text, text, employee_name, policy_cache=policy_cache)
+                if analysis.startswith("[ERROR"):
+                    st.error(f"{fname}: {analysis}")
+                else:
+                    st.markdown(f"**{fname}:**")
+                    st.code(analysis, language="json")
+                    try:
+                        # Remove markdown code block formatting if present (regex only runs on fenced output)
+                        if analysis.lstrip().startswith("```"):
+                            cleaned = _FENCE_RE.sub("", analysis).strip()
+                        else:
+                            cleaned = analysis.strip()
+                        analysis_json = json.loads(cleaned)
+                        analyses.append({
+                            "invoice_id": fname,
+                            "status": analysis_json.get("status", ""),
+                            "reason": analysis_json.get("reason", ""),
+                            "employee_name": analysis_json.get("employee_name", employee_name),
+                            "date": str(date.today()),
+                            "full_text": text
+                        })
+                        cache_analysis(cache_key, analyses[-1])
+                    except Exception as e:
+                        st.error(f"Failed to parse LLM output for {fname}: {e}")
+        finally:
+            delete_policy_cache(policy_cache)
         if analyses:
             add_invoice_analysis_to_vector_db(analyses)
             st.success(f"Uploaded {len(analyses)} analysis results to the vector database.") 
\ No newline at end of file
@@ -0,0 +1,34 @@
+"""
+PDF text extraction for the Invoice Reimbursement System.
+Kept free of heavy imports (Gemini SDKs, FAISS, the embedding model) because it is the
+module that PDF worker processes import.
+"""
+import pypdfium2 as pdfium  # PDFium-backed PDF text extraction
+import logging
+import threading
+
+_PDFIUM_LOCK = threading.Lock()  # Guards every PDFium call made from this process
+
+def extract_pdf_text(file):
+    """
+    Extracts all text from a PDF file or bytes.
+    Returns the extracted text, or an error message if extraction fails.
+    """
+    try:
+        # PDFium is not thread-safe, even across documents, so serialize all in-process calls
+        with _PDFIUM_LOCK:
+            # PDFium accepts bytes or a seekable file object directly
+            pdf = pdfium.PdfDocument(file)
+            try:
+                parts = []
+                for page in pdf:
+                    textpage = page.get_textpage()
+                    parts.append(textpage.get_text_range())
+                    textpage.close()
+                    page.close()
+                return "".join(parts)
+            finally:
+                pdf.close()
+    except Exception as e:
+        logging.error(f"Failed to extract text from PDF: {e}")
+        return f"[ERROR: Could not extract text from PDF: {e}]"
@@ -3,110 +3,389 @@ Utility functions for the Invoice Reimbursement System.
 Includes PDF/ZIP extraction, LLM analysis, and answer generation.
 """
 import zipfile
-from PyPDF2 import PdfReader  # For PDF text extraction
+from pdf_text import extract_pdf_text  # Lightweight module, also the entry point for PDF worker processes
 from google import generativeai as genai
+from google.generativeai import caching  # For Gemini context caching
+from google import genai as google_genai  # New SDK, used for Gemini batch mode
+from google.genai.types import HttpOptions
 import logging
 import re
 import json
-from datetime import date
+from datetime import date, timedelta
 import io
 import os
+import time
+import hashlib
+import sqlite3
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED  # For parallel PDF parsing
+from concurrent.futures.process import BrokenProcessPool
+
+# Upper bound on worker processes used to parse PDFs from a ZIP
+PDF_WORKERS = min(os.cpu_count() or 1, 4)
+# Smaller ZIPs are parsed in-process; shipping PDFs to workers only pays off past these sizes
+PDF_POOL_MIN_FILES = 8
+PDF_POOL_MIN_BYTES = 8 << 20
+ZIP_READ_BUFFER = 1 << 20  # Buffer size for streaming ZIP entries
+GEMINI_MODEL = "gemini-2.5-flash"
+# How long a cached policy prefix lives on the Gemini side
+POLICY_CACHE_TTL = timedelta(minutes=15)
+# Batch mode only pays off for large ZIPs; smaller ones use concurrent per-invoice calls.
+# Batch jobs can take up to 24 hours, so the API returns the job name and results are collected by polling.
+BATCH_MIN_INVOICES = 25
+BATCH_DONE_STATES = {"JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
+# After the first streamed chunk (shown immediately), later chunks are merged per UI flush, to avoid
+# re-rendering on every token: a flush happens after this many chunks or this many seconds
+STREAM_CHUNKS_PER_FLUSH = 6
+STREAM_FLUSH_INTERVAL = 0.25
+# Content-addressed cache of parsed invoice analyses
+ANALYSIS_CACHE_PATH = os.path.join(os.path.dirname(__file__), "analysis_cache.db")
+_analysis_cache = None  # Opened lazily so PDF worker processes never touch it
+_analysis_cache_lock = threading.Lock()
+_pdf_executor = None  # Shared PDF worker pool, created on first large ZIP and kept for the process lifetime
+_pdf_executor_lock = threading.Lock()
+
+# Timeout for batch-mode HTTP calls (milliseconds)
+GEMINI_HTTP_TIMEOUT = 30_000
 
 
 key = os.getenv("GEMINI_API_KEY")
+# Configure Gemini once and share the model object across all calls and threads
+genai.configure(api_key=key)
+_MODEL = genai.GenerativeModel(GEMINI_MODEL)
+_batch_client = None  # google-genai client, created on first batch job and reused
+
+def _get_batch_client():
+    """Returns the shared google-genai client used for batch jobs (reuses its HTTP connections)."""
+    global _batch_client
+    if _batch_client is None:
+        _batch_client = google_genai.Client(api_key=key, http_options=HttpOptions(timeout=GEMINI_HTTP_TIMEOUT))
+    return _batch_client
 
-def extract_pdf_text(file):
+def _get_pdf_executor():
     """
-    Extracts all text from a PDF file or bytes.
-    Returns the extracted text, or an error message if extraction fails.
+    Returns the shared PDF worker pool, creating it on first use.
+    Workers are started with forkserver (spawn where unavailable) rather than fork, so they do not
+    inherit the parent's threads or PDFium state, and only import the lightweight pdf_text module.
     """
-    try:
-        # If file is bytes, wrap in BytesIO for PyPDF2
-        if isinstance(file, bytes):
-            file = io.BytesIO(file)
-        reader = PdfReader(file)
-        text = ""
-        for page in reader.pages:
-            text += page.extract_text() or ""
-        return text
-    except Exception as e:
-        logging.error(f"Failed to extract text from PDF: {e}")
-        return f"[ERROR: Could not extract text from PDF: {e}]"
+    global _pdf_executor
+    with _pdf_executor_lock:
+        if _pdf_executor is None:
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                ctx = multiprocessing.get_context("forkserver")
+                ctx.set_forkserver_preload(["pdf_text"])
+            else:
+                ctx = multiprocessing.get_context("spawn")
+            _pdf_executor = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=ctx)
+        return _pdf_executor
+
+def _reset_pdf_executor(executor):
+    """Drops a broken worker pool so the next large ZIP starts a fresh one."""
+    global _pdf_executor
+    with _pdf_executor_lock:
+        if _pdf_executor is executor:
+            _pdf_executor = None
+    executor.shutdown(wait=False)
 
 def extract_invoices_from_zip(zip_file):
     """
     Extracts all PDFs from a ZIP file-like object or bytes and returns a dict of filename to text.
+    Entries are streamed one at a time, so peak memory is bounded by a few PDFs rather than the whole ZIP.
     Returns a dict with filename as key and extracted text or error message as value.
     """
-    import io
     invoice_texts = {}
     try:
         # If zip_file is bytes, wrap in BytesIO
         if isinstance(zip_file, bytes):
             zip_file = io.BytesIO(zip_file)
         with zipfile.ZipFile(zip_file) as z:
-            for filename in z.namelist():
-                if filename.lower().endswith(".pdf"):
-                    try:
-                        with z.open(filename) as pdf_file:
-                            text = extract_pdf_text(pdf_file)
-                            invoice_texts[filename] = text
-                    except Exception as e:
-                        logging.error(f"Failed to extract {filename} from ZIP: {e}")
-                        invoice_texts[filename] = f"[ERROR: Could not extract PDF: {e}]"
+            pdf_infos = [info for info in z.infolist() if info.filename.lower().endswith(".pdf")]
+            total_size = sum(info.file_size for info in pdf_infos)
+            if PDF_WORKERS <= 1 or (len(pdf_infos) < PDF_POOL_MIN_FILES and total_size < PDF_POOL_MIN_BYTES):
+                # Not worth the round trip to worker processes
+                _parse_pdfs_in_process(z, pdf_infos, invoice_texts)
+                return invoice_texts
+            # Text extraction is CPU-bound, so parse PDFs on the shared worker pool
+            queue = pdf_infos
+            while queue:
+                suspects, rest = _parse_pdfs_in_pool(z, queue, invoice_texts)
+                if not suspects and len(rest) == len(queue):
+                    # The pool broke before taking any work (e.g. workers cannot start)
+                    _parse_pdfs_in_process(z, rest, invoice_texts)
+                    break
+                # A worker died (e.g. on a malformed PDF) and took every PDF in flight with it.
+                # Re-parse those one at a time, so only a PDF that crashes a worker again is reported.
+                for info in suspects:
+                    if _parse_pdfs_in_pool(z, [info], invoice_texts) != ([], []):
+                        logging.error(f"Failed to extract {info.filename} from ZIP: PDF worker process crashed")
+                        invoice_texts[info.filename] = "[ERROR: Could not extract PDF: PDF worker process crashed]"
+                queue = rest
     except Exception as e:
         logging.error(f"Failed to open ZIP file: {e}")
         return {"[ZIP ERROR]": f"Could not open ZIP file: {e}"}
-    return invoice_texts
+    # Keep results in archive order regardless of completion order
+    return {info.filename: invoice_texts[info.filename] for info in pdf_infos}
+
+def _parse_pdfs_in_process(z, infos, invoice_texts):
+    """Parses ZIP entries one after another in this process, storing texts or per-file errors."""
+    for info in infos:
+        blob = _read_zip_entry(z, info, invoice_texts)
+        if blob is not None:
+            invoice_texts[info.filename] = extract_pdf_text(blob)
+
+def _parse_pdfs_in_pool(z, infos, invoice_texts):
+    """
+    Parses ZIP entries on the shared worker pool, storing texts or per-file errors in invoice_texts.
+    If the pool breaks, it is replaced and no further entries are submitted.
+    Returns (entries lost with the broken pool, entries never submitted); both are empty on success.
+    """
+    executor = _get_pdf_executor()
+    futures = {}
+    broken = False
+    i = 0
+    while i < len(infos) and not broken:
+        # Bound the number of PDFs held in memory while workers catch up
+        if len(futures) >= 2 * PDF_WORKERS:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                broken |= not _collect_pdf_future(futures.pop(future).filename, future, invoice_texts)
+            continue
+        info = infos[i]
+        blob = _read_zip_entry(z, info, invoice_texts)
+        if blob is not None:
+            try:
+                futures[executor.submit(extract_pdf_text, blob)] = info
+            except BrokenProcessPool:
+                broken = True
+                break
+        i += 1
+    for future, info in futures.items():
+        broken |= not _collect_pdf_future(info.filename, future, invoice_texts)
+    if not broken:
+        return [], []
+    _reset_pdf_executor(executor)
+    return [info for info in infos[:i] if info.filename not in invoice_texts], infos[i:]
+
+def _read_zip_entry(z, info, invoice_texts):
+    """Reads one ZIP entry through a 1 MiB buffer; records an error and returns None on failure."""
+    try:
+        with z.open(info) as pf:
+            return io.BufferedReader(pf, buffer_size=ZIP_READ_BUFFER).read()
+    except Exception as e:
+        logging.error(f"Failed to extract {info.filename} from ZIP: {e}")
+        invoice_texts[info.filename] = f"[ERROR: Could not extract PDF: {e}]"
+        return None
+
+def _collect_pdf_future(filename, future, invoice_texts):
+    """
+    Stores the text from a finished PDF extraction future, converting worker failures to errors.
+    Returns False, recording nothing, if the worker pool broke; the entry can then be retried.
+    """
+    try:
+        invoice_texts[filename] = future.result()
+    except BrokenProcessPool:
+        return False
+    except Exception as e:
+        logging.error(f"Failed to extract {filename} from ZIP: {e}")
+        invoice_texts[filename] = f"[ERROR: Could not extract PDF: {e}]"
+    return True
 
-def analyze_invoice_with_gemini(policy_text, invoice_text, employee_name, api_key= "Enter your gemini api key here"):
+def create_policy_cache(policy_text):
+    """
+    Uploads the HR policy to Gemini context caching so it is tokenized once per batch.
+    Returns the CachedContent handle, or None if caching is unavailable (e.g. the policy
+    is below the model's minimum cacheable size); callers then fall back to inline prompts.
+    """
+    try:
+        return caching.CachedContent.create(
+            model=f"models/{GEMINI_MODEL}",
+            display_name="hr-reimbursement-policy",
+            contents=[f"HR Policy:\n{policy_text}"],
+            ttl=POLICY_CACHE_TTL,
+        )
+    except Exception as e:
+        logging.warning(f"Gemini policy caching unavailable, sending policy inline: {e}")
+        return None
+
+def delete_policy_cache(policy_cache):
+    """Releases a cached policy prefix created by create_policy_cache."""
+    if policy_cache is None:
+        return
+    try:
+        policy_cache.delete()
+    except Exception as e:
+        logging.warning(f"Failed to delete Gemini policy cache: {e}")
+
+def analyze_invoice_with_gemini(policy_text, invoice_text, employee_name, policy_cache=None):
     """
     Uses Gemini LLM to analyze an invoice against a policy and return the analysis.
+    If policy_cache is given, the policy is read from the cached prefix instead of the prompt.
     Returns a JSON string with status, reason, and employee name.
     """
     try:
-        if api_key:
-            genai.configure(api_key=api_key)
-        # Construct prompt for LLM
-        prompt = f"""
+        prompt = _build_analysis_prompt(policy_text, invoice_text, employee_name, include_policy=policy_cache is None)
+        if policy_cache is not None:
+            model = genai.GenerativeModel.from_cached_content(cached_content=policy_cache)
+        else:
+            model = _MODEL
+        response = model.generate_content(prompt)
+        return response.text
+    except Exception as e:
+        logging.error(f"Gemini LLM analysis failed: {e}")
+        return f"[ERROR: Gemini LLM analysis failed: {e}]"
+
+def submit_invoice_batch(policy_text, invoice_texts, employee_name):
+    """
+    Submits many invoice analyses as a single Gemini inline batch job instead of one request per invoice.
+    The policy is sent inline in every prompt: a job can outlive the POLICY_CACHE_TTL of a cached prefix.
+    Args:
+        policy_text (str): Extracted HR policy text.
+        invoice_texts (dict): Filename to extracted invoice text.
+        employee_name (str): Employee the invoices belong to.
+    Returns:
+        str: The batch job name, to pass to get_invoice_batch_results,
+        or None if the job could not be submitted so callers can fall back to per-invoice calls.
+    """
+    inline_requests = [
+        {"contents": [{"role": "user", "parts": [{"text": _build_analysis_prompt(policy_text, text, employee_name)}]}]}
+        for text in invoice_texts.values()
+    ]
+    try:
+        batch_job = _get_batch_client().batches.create(
+            model=f"models/{GEMINI_MODEL}",
+            src=inline_requests,
+            config={"display_name": f"invoice-analysis-{employee_name}"},
+        )
+        return batch_job.name
+    except Exception as e:
+        logging.error(f"Gemini batch submission failed: {e}")
+        return None
+
+def get_invoice_batch_results(job_name, fnames):
+    """
+    Checks a batch job submitted by submit_invoice_batch.
+    Args:
+        job_name (str): Batch job name.
+        fnames (list): Invoice filenames, in the order they were submitted.
+    Returns:
+        tuple: (job state name, results). Results is a dict of filename to raw LLM response text
+        (or an [ERROR ...] string per invoice) once the job has succeeded, and None otherwise;
+        a job that ended in any other state in BATCH_DONE_STATES produced no usable output.
+    """
+    batch_job = _get_batch_client().batches.get(name=job_name)
+    if batch_job.state.name != "JOB_STATE_SUCCEEDED":
+        return batch_job.state.name, None
+    # Inline responses come back in request order
+    results = {}
+    for fname, inline_response in zip(fnames, batch_job.dest.inlined_responses):
+        if inline_response.response is not None:
+            results[fname] = inline_response.response.text
+        else:
+            results[fname] = f"[ERROR: Gemini LLM analysis failed: {inline_response.error}]"
+    for fname in fnames[len(results):]:
+        results[fname] = "[ERROR: Gemini LLM analysis failed: no response in batch output]"
+    return batch_job.state.name, results
+
+def _build_analysis_prompt(policy_text, invoice_text, employee_name, include_policy=True):
+    """Builds the invoice analysis prompt; the policy is omitted when it lives in a cached prefix."""
+    prompt = f"""
         You are an expert HR reimbursement analyst. Given the following HR reimbursement policy and an employee's invoice, analyze the invoice and determine the reimbursement status. Use these categories: Fully Reimbursed, Partially Reimbursed, Declined. For each, provide a clear, detailed reason based on the policy. Return your answer in this JSON format:
         {{
             "status": "<Fully Reimbursed|Partially Reimbursed|Declined>",
             "reason": "<detailed reason>",
             "employee_name": "{employee_name}"
         }}
-
+        """
+    if include_policy:
+        prompt += f"""
         HR Policy:
         {policy_text}
-
+        """
+    prompt += f"""
         Invoice:
         {invoice_text}
         """
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        response = model.generate_content(prompt)
-        return response.text
-    except Exception as e:
-        logging.error(f"Gemini LLM analysis failed: {e}")
-        return f"[ERROR: Gemini LLM analysis failed: {e}]"
+    return prompt
+
+def analysis_cache_key(policy_text, invoice_text, employee_name):
+    """Returns the SHA-256 hex digest identifying an (policy, invoice, employee) analysis."""
+    digest = hashlib.sha256()
+    for part in (policy_text, invoice_text, employee_name):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")  # Separator so field boundaries can't shift between inputs
+    return digest.hexdigest()
 
-def answer_query_with_gemini(search_query, results, api_key= "Enter your gemini api key here" ):
+def _get_analysis_cache():
+    """Opens (once) the sqlite key-value table backing the analysis cache."""
+    global _analysis_cache
+    if _analysis_cache is None:
+        _analysis_cache = sqlite3.connect(ANALYSIS_CACHE_PATH, isolation_level=None, check_same_thread=False)
+        _analysis_cache.execute("PRAGMA journal_mode=WAL")
+        _analysis_cache.execute("CREATE TABLE IF NOT EXISTS analysis_cache (key TEXT PRIMARY KEY, analysis TEXT)")
+        # Inputs of submitted Gemini batch jobs, kept until their results are collected
+        _analysis_cache.execute("CREATE TABLE IF NOT EXISTS batch_jobs (name TEXT PRIMARY KEY, job TEXT)")
+    return _analysis_cache
+
+def get_cached_analysis(cache_key):
+    """
+    Returns the cached analysis fields (status, reason, employee_name) for a cache key, or None.
+    """
+    with _analysis_cache_lock:
+        row = _get_analysis_cache().execute(
+            "SELECT analysis FROM analysis_cache WHERE key = ?", (cache_key,)
+        ).fetchone()
+    return json.loads(row[0]) if row else None
+
+def cache_analysis(cache_key, analysis):
+    """Stores the status, reason and employee name of a successfully parsed analysis."""
+    fields = {k: analysis[k] for k in ("status", "reason", "employee_name")}
+    with _analysis_cache_lock:
+        _get_analysis_cache().execute(
+            "INSERT OR REPLACE INTO analysis_cache VALUES (?, ?)", (cache_key, json.dumps(fields))
+        )
+
+def save_batch_job(job_name, job):
+    """Records the inputs of a submitted batch job (a JSON-serializable dict) until its results are collected."""
+    with _analysis_cache_lock:
+        _get_analysis_cache().execute("INSERT OR REPLACE INTO batch_jobs VALUES (?, ?)", (job_name, json.dumps(job)))
+
+def get_batch_job(job_name):
+    """Returns the inputs recorded for a batch job, or None if it is unknown or already collected."""
+    with _analysis_cache_lock:
+        row = _get_analysis_cache().execute("SELECT job FROM batch_jobs WHERE name = ?", (job_name,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+def claim_batch_job(job_name):
+    """
+    Removes a batch job record. Returns True for exactly one caller, across threads and processes,
+    so a finished job's results are stored only once.
+    """
+    with _analysis_cache_lock:
+        cursor = _get_analysis_cache().execute("DELETE FROM batch_jobs WHERE name = ?", (job_name,))
+    return cursor.rowcount == 1
+
+def _render_context(meta):
+    """Renders a context block for a metadata dict that lacks a prerendered one."""
+    # Imported lazily so utils never loads the embedding model itself; results come from vector_store,
+    # so by the time this runs it is already imported
+    from vector_store import render_invoice_context
+    return render_invoice_context(meta)
+
+def answer_query_with_gemini(search_query, results, stream=False):
     """
     Uses Gemini LLM to answer a user query based on the context and similarity search results.
     Args:
         search_query (str): The user's search query.
         results (list): List of (score, meta) tuples from similarity search.
-        api_key (str, optional): Gemini API key. If None, uses default config.
+        stream (bool, optional): If True, return an iterator of text pieces as Gemini generates them.
     Returns:
-        str: Markdown-formatted answer from Gemini.
+        str: Markdown-formatted answer from Gemini (an iterator of str when stream is True).
     """
     try:
-        if api_key:
-            genai.configure(api_key=api_key)
         # Prepare context from results for the LLM prompt
-        context = "\n\n".join([
-            f"Invoice ID: {meta.get('invoice_id', 'N/A')}\nStatus: {meta.get('status', 'N/A')}\nReason: {meta.get('reason', 'N/A')}\nEmployee: {meta.get('employee_name', 'N/A')}\nDate: {meta.get('date', 'N/A')}"
-            for _, meta in results
-        ])
+        # Rows from the vector store carry their block prerendered at insert time
+        context = "\n\n".join([meta.get("context") or _render_context(meta) for _, meta in results])
         rag_prompt = f"""
 You are an intelligent assistant for invoice reimbursement queries. Given the following user query and a set of relevant invoice analyses, provide a clear, structured, and helpful answer in markdown format. If possible, summarize the findings, highlight any patterns, and answer the user's question directly.
 
@@ -116,9 +395,33 @@ User Query:
 Relevant Invoice Analyses:
 {context}
 """
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        response = model.generate_content(rag_prompt)
+        if stream:
+            return _batch_stream_chunks(_MODEL.generate_content(rag_prompt, stream=True))
+        response = _MODEL.generate_content(rag_prompt)
         return response.text
     except Exception as e:
         logging.error(f"Gemini LLM answer generation failed: {e}")
-        return f"[ERROR: Gemini LLM answer generation failed: {e}]" 
\ No newline at end of file
+        error = f"[ERROR: Gemini LLM answer generation failed: {e}]"
+        return iter([error]) if stream else error
+
+def _batch_stream_chunks(response, chunks_per_flush=STREAM_CHUNKS_PER_FLUSH, flush_interval=STREAM_FLUSH_INTERVAL):
+    """
+    Yields the text of a streamed Gemini response. The first chunk is yielded as soon as it arrives;
+    later ones are merged until chunks_per_flush have arrived or flush_interval seconds have passed.
+    Errors raised mid-stream are yielded as an [ERROR ...] message after any text received so far.
+    """
+    buffer = []
+    last_flush = None  # None until the first chunk has been yielded
+    try:
+        for chunk in response:
+            buffer.append(chunk.text)
+            now = time.monotonic()
+            if last_flush is None or len(buffer) >= chunks_per_flush or now - last_flush >= flush_interval:
+                yield "".join(buffer)
+                buffer = []
+                last_flush = now
+    except Exception as e:
+        logging.error(f"Gemini LLM answer generation failed: {e}")
+        buffer.append(f"\n\n[ERROR: Gemini LLM answer generation failed: {e}]")
+    if buffer:
+        yield "".join(buffer) 
\ No newline at end of file
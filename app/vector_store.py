@@ -4,24 +4,276 @@ Handles embedding, FAISS index management, and combined metadata/similarity sear
 """
 import faiss  # Facebook AI Similarity Search for fast vector search
 import numpy as np
-from sentence_transformers import SentenceTransformer  # For text embeddings
+from embeddings import QuantizedEmbeddingModel  # int8 ONNX MiniLM for text embeddings
 import os
 import pickle
 import re
+import sqlite3
+import threading
+import atexit
+import logging
+from functools import lru_cache
+from contextlib import contextmanager
 
 # Paths for storing FAISS index and metadata
 FAISS_INDEX_PATH = os.path.join(os.path.dirname(__file__), "faiss_index.bin")
-FAISS_META_PATH = os.path.join(os.path.dirname(__file__), "faiss_metadata.pkl")
-embedding_model = SentenceTransformer("all-MiniLM-L6-v2")  # Embedding model
+FAISS_META_PATH = os.path.join(os.path.dirname(__file__), "faiss_metadata.pkl")  # Legacy, imported once
+META_DB_PATH = os.path.join(os.path.dirname(__file__), "faiss_metadata.db")
+VECTORS_PATH = os.path.join(os.path.dirname(__file__), "faiss_vectors.npy")
+QUERY_CACHE_PATH = os.path.join(os.path.dirname(__file__), "query_cache.pkl")
+embedding_model = QuantizedEmbeddingModel()  # Embedding model (all-MiniLM-L6-v2, int8 ONNX)
+
+EMBEDDING_DIM = 384  # Embedding size for all-MiniLM-L6-v2
+# HNSW graph parameters: neighbours per node, build-time and query-time beam widths
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64
+# Candidate sets smaller than this are scored exactly with numpy instead of searched through FAISS
+NUMPY_SEARCH_THRESHOLD = 2000
+# Flat indexes larger than this are migrated to HNSW on load
+HNSW_MIGRATION_THRESHOLD = 1000
+# Past this many vectors the index is product-quantized (IVF-PQ): 48 one-byte codes per vector
+# instead of 1536 bytes of float32. Search becomes approximate, with error bounded by training quality.
+PQ_THRESHOLD = 10_000
+IVF_NLIST = 256  # Coarse k-means clusters
+PQ_M = 48  # Sub-quantizers (384 / 48 = 8 dims each)
+PQ_NBITS = 8  # Bits per sub-quantizer code
+IVF_NPROBE = 16  # Clusters visited per query
+
+def _replace_file(path, write):
+    """
+    Writes a file through write(f) into a per-process temp file, then renames it over `path`.
+    Readers (and memory maps of the old file) never see a partially written file.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+def _new_hnsw_index():
+    """Creates an empty inner-product HNSW index for sub-linear similarity search."""
+    index = faiss.IndexHNSWFlat(EMBEDDING_DIM, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+    index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    return index
+
+def _upgrade_index(index):
+    """
+    Migrates a persisted index to the current layout, rewriting it on disk if anything changed.
+    Legacy L2 indexes held unnormalized embeddings, so their vectors are L2-normalized and
+    re-added with the inner-product metric; large flat indexes are rebuilt as HNSW.
+    """
+    is_l2 = index.metric_type != faiss.METRIC_INNER_PRODUCT
+    is_large_flat = isinstance(index, faiss.IndexFlat) and index.ntotal > HNSW_MIGRATION_THRESHOLD
+    if not (is_l2 or is_large_flat):
+        return index
+    vectors = index.reconstruct_n(0, index.ntotal)
+    if is_l2:
+        faiss.normalize_L2(vectors)
+    if isinstance(index, faiss.IndexHNSW) or index.ntotal > HNSW_MIGRATION_THRESHOLD:
+        new_index = _new_hnsw_index()
+    else:
+        new_index = faiss.IndexFlatIP(EMBEDDING_DIM)
+    new_index.add(vectors)
+    _replace_file(FAISS_INDEX_PATH, faiss.serialize_index(new_index).tofile)
+    return new_index
+
+def _new_ivfpq_index(vectors):
+    """Trains an inner-product IVF-PQ index on the given vectors and adds them to it."""
+    quantizer = faiss.IndexFlatIP(EMBEDDING_DIM)
+    index = faiss.IndexIVFPQ(quantizer, EMBEDDING_DIM, IVF_NLIST, PQ_M, PQ_NBITS, faiss.METRIC_INNER_PRODUCT)
+    index.train(vectors)
+    index.add(vectors)
+    index.nprobe = IVF_NPROBE
+    return index
+
+def _reconstruct_all(index):
+    """Returns every vector stored in the index as an (ntotal, dim) float32 array."""
+    if isinstance(index, faiss.IndexIVF):
+        index.make_direct_map()
+    return index.reconstruct_n(0, index.ntotal)
+
+# Metadata fields persisted per invoice, in table column order
+META_FIELDS = ("invoice_id", "status", "reason", "employee_name", "date")
+# The FAISS index is rewritten after this many inserted vectors (and at shutdown), not on every insert;
+# vectors inserted since the last write are recovered from the metadata store on load.
+FAISS_SAVE_INTERVAL = 500
+
+def _open_meta_db():
+    """Opens the append-only sqlite metadata store; rowid matches the FAISS vector id."""
+    conn = sqlite3.connect(META_DB_PATH, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS metadata ("
+        "rowid INTEGER PRIMARY KEY, invoice_id TEXT, status TEXT, reason TEXT, "
+        "employee_name TEXT, date TEXT, embedding BLOB)"
+    )
+    return conn
+
+@contextmanager
+def _write_transaction():
+    """
+    Runs a block in a write-locked sqlite transaction. BEGIN IMMEDIATE serializes writers across
+    processes sharing the store (e.g. Streamlit and the API), so rowids can be allocated safely.
+    """
+    _meta_db.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+    except Exception:
+        _meta_db.execute("ROLLBACK")
+        raise
+    _meta_db.execute("COMMIT")
+
+def _insert_metadata_rows(start, metas, embeddings):
+    """Appends metadata rows (with their embeddings) starting at rowid `start`; call inside _write_transaction."""
+    rows = [
+        (start + i, *(meta[k] for k in META_FIELDS), embedding.tobytes())
+        for i, (meta, embedding) in enumerate(zip(metas, embeddings))
+    ]
+    _meta_db.executemany("INSERT INTO metadata VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+def _stored_embeddings(start=0):
+    """Reads embeddings from the metadata store for rowids >= start as an (N, dim) float32 array."""
+    rows = _meta_db.execute("SELECT embedding FROM metadata WHERE rowid >= ? ORDER BY rowid", (start,)).fetchall()
+    return np.frombuffer(b"".join(row[0] for row in rows), dtype='float32').reshape(-1, EMBEDDING_DIM)
 
 # Load or initialize FAISS index and metadata
-if os.path.exists(FAISS_INDEX_PATH) and os.path.exists(FAISS_META_PATH):
-    faiss_index = faiss.read_index(FAISS_INDEX_PATH)
-    with open(FAISS_META_PATH, "rb") as f:
-        metadata_list = pickle.load(f)
+_meta_db = _open_meta_db()
+if os.path.exists(FAISS_INDEX_PATH):
+    faiss_index = _upgrade_index(faiss.read_index(FAISS_INDEX_PATH))
 else:
-    faiss_index = faiss.IndexFlatL2(384)  # 384 is the embedding size for all-MiniLM-L6-v2
-    metadata_list = []
+    faiss_index = _new_hnsw_index()
+if os.path.exists(FAISS_META_PATH):
+    with _write_transaction():
+        # One-time import of the legacy pickled metadata list (re-checked under the write lock)
+        if _meta_db.execute("SELECT COUNT(*) FROM metadata").fetchone()[0] == 0:
+            with open(FAISS_META_PATH, "rb") as f:
+                legacy_metadata = pickle.load(f)
+            if faiss_index.ntotal >= len(legacy_metadata):
+                _insert_metadata_rows(0, legacy_metadata, _reconstruct_all(faiss_index)[:len(legacy_metadata)])
+            else:
+                logging.warning(f"Skipping import of {FAISS_META_PATH}: index has fewer vectors than metadata rows")
+
+def render_invoice_context(meta):
+    """Formats one invoice's metadata as a context block for the chatbot prompt."""
+    return f"Invoice ID: {meta.get('invoice_id', 'N/A')}\nStatus: {meta.get('status', 'N/A')}\nReason: {meta.get('reason', 'N/A')}\nEmployee: {meta.get('employee_name', 'N/A')}\nDate: {meta.get('date', 'N/A')}"
+
+def _with_context(meta):
+    """Attaches the prerendered chatbot context block to a metadata dict."""
+    meta["context"] = render_invoice_context(meta)
+    return meta
+
+metadata_list = [
+    _with_context(dict(zip(META_FIELDS, row)))
+    for row in _meta_db.execute(f"SELECT {', '.join(META_FIELDS)} FROM metadata ORDER BY rowid")
+]
+if faiss_index.ntotal > len(metadata_list):
+    # Vectors without metadata (e.g. the metadata store was removed): rebuild from the store
+    faiss_index = _new_hnsw_index()
+
+def _append_vectors(embeddings):
+    """
+    Appends rows to the vector mirror, growing its buffer by doubling so inserts copy amortized O(1) rows.
+    Rows already in _vectors are never written again, so views taken earlier stay valid.
+    """
+    global _vectors_buf, _vectors
+    n, needed = len(_vectors), len(_vectors) + len(embeddings)
+    if not _vectors_buf.flags.writeable or needed > len(_vectors_buf):
+        # First insert after a memory-mapped load, or out of capacity: move to a larger buffer
+        buf = np.empty((max(needed, 2 * len(_vectors_buf), 1024), EMBEDDING_DIM), dtype='float32')
+        buf[:n] = _vectors
+        _vectors_buf = buf
+    _vectors_buf[n:needed] = embeddings
+    _vectors = _vectors_buf[:needed]
+
+# In-memory (N, dim) mirror of the indexed vectors, so nothing needs to reconstruct them from FAISS.
+# _vectors is a view of the first N rows of _vectors_buf, which holds spare capacity for inserts.
+# Memory-mapped from disk at startup; rows saved since the last write are recovered from the store.
+_vectors_buf = np.load(VECTORS_PATH, mmap_mode='r') if os.path.exists(VECTORS_PATH) else None
+if _vectors_buf is None or _vectors_buf.shape[0] > len(metadata_list):
+    _vectors_buf = _stored_embeddings()
+_vectors = _vectors_buf
+if len(_vectors) < len(metadata_list):
+    _append_vectors(_stored_embeddings(len(_vectors)))
+
+if faiss_index.ntotal < len(metadata_list):
+    # Recover vectors inserted after the last index write
+    faiss_index.add(np.array(_vectors[faiss_index.ntotal:]))
+    _replace_file(FAISS_INDEX_PATH, faiss.serialize_index(faiss_index).tofile)
+if not isinstance(faiss_index, faiss.IndexIVFPQ) and faiss_index.ntotal > PQ_THRESHOLD:
+    faiss_index = _new_ivfpq_index(np.array(_vectors))
+    _replace_file(FAISS_INDEX_PATH, faiss.serialize_index(faiss_index).tofile)
+if isinstance(faiss_index, faiss.IndexHNSW):
+    faiss_index.hnsw.efSearch = HNSW_EF_SEARCH
+elif isinstance(faiss_index, faiss.IndexIVF):
+    faiss_index.nprobe = IVF_NPROBE
+
+# Filterable metadata fields, kept as parallel prelowered string columns for vectorized filtering
+FILTER_COLUMNS = ("invoice_id", "status", "employee_name", "date")
+
+def _build_columns(metas):
+    """Converts a list of metadata dicts into a dict of lowercase numpy string columns."""
+    return {
+        k: np.array([str(meta.get(k, "")).lower() for meta in metas], dtype=str)
+        for k in FILTER_COLUMNS
+    }
+
+def _append_columns(metas):
+    """
+    Appends metadata rows to the filter columns. Like the vector mirror, each column's buffer grows by
+    doubling, and is only reallocated early when a value longer than its fixed string width arrives,
+    so inserts copy amortized O(1) rows. Rows already in _cols are never written again.
+    """
+    global _cols
+    n = len(_cols[FILTER_COLUMNS[0]])
+    new_cols = _build_columns(metas)
+    for k in FILTER_COLUMNS:
+        buf, values = _col_bufs[k], new_cols[k]
+        dtype = np.result_type(buf.dtype, values.dtype)  # The wider of the two fixed-width string types
+        if dtype != buf.dtype or n + len(values) > len(buf):
+            new_buf = np.empty(max(n + len(values), 2 * len(buf), 1024), dtype=dtype)
+            new_buf[:n] = buf[:n]
+            _col_bufs[k] = buf = new_buf
+        buf[n:n + len(values)] = values
+    # A new dict of views, so searches holding the previous one keep a consistent snapshot
+    _cols = {k: _col_bufs[k][:n + len(metas)] for k in FILTER_COLUMNS}
+
+# _cols maps each filter column to a view of the first N rows of its buffer in _col_bufs
+_col_bufs = _build_columns(metadata_list)
+_cols = dict(_col_bufs)
+# Guards the index, metadata and columns against concurrent inserts and searches
+_index_lock = threading.Lock()
+_save_lock = threading.Lock()  # Serializes index writes, so an older snapshot never replaces a newer one
+_unsaved_vectors = 0  # Vectors added since the FAISS index was last written
+
+# Semantic cache of chatbot replies, keyed by the normalized query embedding
+QUERY_CACHE_SIZE = 10_000  # Oldest entries are evicted first beyond this
+QUERY_CACHE_THRESHOLD = 0.9  # Minimum cosine similarity for a cache hit
+QUERY_CACHE_SAVE_INTERVAL = 50  # Cached replies between writes of query_cache.pkl
+_qcache_lock = threading.Lock()
+# Fixed-size ring buffer: inserts overwrite the oldest slot instead of copying the cache
+_qcache_vecs = np.zeros((QUERY_CACHE_SIZE, EMBEDDING_DIM), dtype='float32')
+_qcache_filters = [None] * QUERY_CACHE_SIZE
+_qcache_replies = [None] * QUERY_CACHE_SIZE
+_qcache_count = 0  # Occupied slots
+_qcache_next = 0  # Slot the next reply is written to
+_qcache_unsaved = 0  # Replies cached since query_cache.pkl was last written
+_qcache_generation = 0  # Bumped on every clear, so an in-flight save cannot restore stale replies
+if os.path.exists(QUERY_CACHE_PATH):
+    with open(QUERY_CACHE_PATH, "rb") as f:
+        saved = pickle.load(f)
+    # Stored oldest first, tagged with the number of stored invoices the replies were answered against.
+    # Replies saved against a different store (or in the untagged legacy format) may be stale.
+    if len(saved) == 4 and saved[0] == len(metadata_list):
+        _, vecs, filters, replies = saved
+        _qcache_count = min(len(replies), QUERY_CACHE_SIZE)
+    else:
+        logging.info(f"Discarding {QUERY_CACHE_PATH}: saved against a different invoice store")
+    if _qcache_count:
+        _qcache_vecs[:_qcache_count] = vecs[-_qcache_count:]
+        _qcache_filters[:_qcache_count] = filters[-_qcache_count:]
+        _qcache_replies[:_qcache_count] = replies[-_qcache_count:]
+    _qcache_next = _qcache_count % QUERY_CACHE_SIZE
 
 def add_invoice_analysis_to_vector_db(analyses):
     """
@@ -29,60 +281,278 @@ def add_invoice_analysis_to_vector_db(analyses):
     Each dict should have: invoice_id, status, reason, employee_name, date, full_text
     Embeds the analysis and updates the index and metadata.
     """
-    global faiss_index, metadata_list
-    for analysis in analyses:
-        # Combine invoice text and analysis for embedding
-        text_to_embed = analysis["full_text"] + "\nStatus: " + analysis["status"] + "\nReason: " + analysis["reason"]
-        embedding = embedding_model.encode(text_to_embed)
-        embedding = np.array([embedding]).astype('float32')
-        faiss_index.add(embedding)
-        metadata_list.append({
-            "invoice_id": analysis["invoice_id"],
-            "status": analysis["status"],
-            "reason": analysis["reason"],
-            "employee_name": analysis["employee_name"],
-            "date": analysis["date"]
+    if not analyses:
+        return
+    # Combine invoice text and analysis for embedding
+    texts = [
+        a["full_text"] + "\nStatus: " + a["status"] + "\nReason: " + a["reason"]
+        for a in analyses
+    ]
+    metas = [
+        _with_context({
+            "invoice_id": a["invoice_id"],
+            "status": a["status"],
+            "reason": a["reason"],
+            "employee_name": a["employee_name"],
+            "date": a["date"]
         })
-    # Persist index and metadata to disk
-    faiss.write_index(faiss_index, FAISS_INDEX_PATH)
-    with open(FAISS_META_PATH, "wb") as f:
-        pickle.dump(metadata_list, f)
+        for a in analyses
+    ]
+    # Encode all analyses in one batched forward pass instead of one call per invoice.
+    # Embeddings are L2-normalized so inner product equals cosine similarity.
+    embeddings = embedding_model.encode(
+        texts,
+        batch_size=32,
+        convert_to_numpy=True,
+        normalize_embeddings=True,
+        show_progress_bar=False,
+    ).astype('float32')
+    with _index_lock:
+        with _write_transaction():
+            # Other processes may have appended rows since we last looked; rowids must stay contiguous
+            _sync_from_store_locked()
+            _insert_metadata_rows(len(metadata_list), metas, embeddings)
+        _append_locked(metas, embeddings)
+        due_for_save = _unsaved_vectors >= FAISS_SAVE_INTERVAL
+    if due_for_save:
+        _write_index()
+    _maybe_compress_index()
+    # Cached chatbot replies no longer reflect the stored invoices
+    clear_query_cache()
+
+def _append_locked(metas, embeddings):
+    """Adds rows already persisted in the store to the in-memory index and columns; caller holds _index_lock."""
+    global _unsaved_vectors
+    faiss_index.add(embeddings)
+    _append_vectors(embeddings)
+    metadata_list.extend(metas)
+    _append_columns(metas)
+    _unsaved_vectors += len(metas)
+
+def _sync_from_store_locked():
+    """
+    Loads rows appended to the shared metadata store by other processes; caller holds _index_lock.
+    Returns the number of rows loaded.
+    """
+    rows = _meta_db.execute(
+        f"SELECT {', '.join(META_FIELDS)}, embedding FROM metadata WHERE rowid >= ? ORDER BY rowid",
+        (len(metadata_list),),
+    ).fetchall()
+    if not rows:
+        return 0
+    metas = [_with_context(dict(zip(META_FIELDS, row[:-1]))) for row in rows]
+    embeddings = np.frombuffer(b"".join(row[-1] for row in rows), dtype='float32').reshape(-1, EMBEDDING_DIM)
+    _append_locked(metas, embeddings)
+    return len(rows)
+
+def _refresh_from_store():
+    """Picks up invoices stored by other processes before a search."""
+    with _index_lock:
+        if _meta_db.execute("SELECT COALESCE(MAX(rowid), -1) FROM metadata").fetchone()[0] < len(metadata_list):
+            return
+        _sync_from_store_locked()
+    # Cached chatbot replies no longer reflect the stored invoices
+    clear_query_cache()
+
+def _write_index():
+    """
+    Writes the FAISS index and the vector mirror to disk; callers must not hold _index_lock.
+    Only the in-memory serialization runs under the lock; searches continue during the file writes.
+    """
+    global _unsaved_vectors
+    with _save_lock:
+        with _index_lock:
+            index_data = faiss.serialize_index(faiss_index)
+            vectors = _vectors  # Mirror rows are never rewritten, so this view is a stable snapshot
+            _unsaved_vectors = 0
+        _replace_file(FAISS_INDEX_PATH, index_data.tofile)
+        _replace_file(VECTORS_PATH, lambda f: np.save(f, vectors))
+
+def save_index():
+    """Flushes any vectors added since the last write to the on-disk FAISS index."""
+    if _unsaved_vectors:
+        _write_index()
+
+atexit.register(save_index)
+
+def _maybe_compress_index():
+    """
+    Swaps the index for a product-quantized IVF-PQ index once it grows past PQ_THRESHOLD.
+    Training runs outside the lock so searches continue against the old index meanwhile;
+    vectors inserted during training are carried over before the swap.
+    """
+    global faiss_index
+    with _index_lock:
+        if isinstance(faiss_index, faiss.IndexIVFPQ) or faiss_index.ntotal <= PQ_THRESHOLD:
+            return
+        vectors = _vectors
+    new_index = _new_ivfpq_index(np.array(vectors))
+    with _index_lock:
+        if isinstance(faiss_index, faiss.IndexIVFPQ):
+            return  # Another insert already swapped the index
+        if len(_vectors) > len(vectors):
+            new_index.add(np.array(_vectors[len(vectors):]))
+        faiss_index = new_index
+    _write_index()
 
 def search_invoices(query, top_k=5, filters=None):
     """
     Search the FAISS index for invoices similar to the query string, optionally filtering by metadata.
-    Returns a list of (score, metadata) tuples.
+    Returns a list of (score, metadata) tuples, where score is cosine similarity (higher is more similar).
     """
-    if len(metadata_list) == 0:
+    # Encode query (normalized, already a float32 ndarray)
+    query_vec = _embed_query(query)[np.newaxis, :]
+    _refresh_from_store()
+    # Snapshot references only; inserts append past n and replace _cols, so the snapshot stays consistent
+    with _index_lock:
+        n, cols, vectors = len(metadata_list), _cols, _vectors
+    if n == 0:
         return []
-    # Apply metadata filters if provided
-    filtered_indices = list(range(len(metadata_list)))
+    # Apply metadata filters if provided (case-insensitive substring match per column)
     if filters:
-        def match(meta):
-            # Check if all filter values are present in metadata (case-insensitive)
-            for k, v in filters.items():
-                if k in meta and v.lower() not in str(meta[k]).lower():
-                    return False
-            return True
-        filtered_indices = [i for i, meta in enumerate(metadata_list) if match(meta)]
-    if not filtered_indices:
+        mask = np.ones(n, dtype=bool)
+        for k, v in filters.items():
+            if k in cols:
+                mask &= np.char.find(cols[k], v.lower()) >= 0
+        filtered_indices = np.nonzero(mask)[0]
+    else:
+        filtered_indices = np.arange(n)
+    if len(filtered_indices) == 0:
         return []
-    # Prepare filtered embeddings and metadata
-    filtered_embeddings = faiss_index.reconstruct_n(0, len(metadata_list))
-    filtered_embeddings = [filtered_embeddings[i] for i in filtered_indices]
-    filtered_embeddings = np.array(filtered_embeddings).astype('float32')
-    # Encode query
-    query_vec = embedding_model.encode(query)
-    query_vec = np.array([query_vec]).astype('float32')
-    # Build a temporary FAISS index for filtered subset
-    temp_index = faiss.IndexFlatL2(filtered_embeddings.shape[1])
-    temp_index.add(filtered_embeddings)
-    D, I = temp_index.search(query_vec, min(top_k, len(filtered_indices)))
-    results = []
-    for idx, score in zip(I[0], D[0]):
-        real_idx = filtered_indices[idx]
-        results.append((score, metadata_list[real_idx]))
-    return results
+    k = min(top_k, len(filtered_indices))
+    if len(filtered_indices) < NUMPY_SEARCH_THRESHOLD:
+        # Small candidate set: one matmul against the vector mirror beats a FAISS search
+        scores = vectors[filtered_indices] @ query_vec[0]
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[i]), metadata_list[filtered_indices[i]]) for i in top]
+    # FAISS indexes are not safe to search while another thread adds to or swaps them
+    with _index_lock:
+        if len(filtered_indices) == n:
+            # No effective filter: query the main index directly
+            D, I = faiss_index.search(query_vec, k)
+        else:
+            # Let FAISS apply the metadata filter inside its own search
+            D, I = faiss_index.search(query_vec, k, params=_search_params(filtered_indices))
+        return [(score, metadata_list[idx]) for idx, score in zip(I[0], D[0]) if idx != -1]
+
+def _search_params(filtered_indices):
+    """
+    Builds FAISS search parameters restricting the search to the given row ids.
+    Index ids are assigned sequentially on insert, so they line up with metadata_list positions.
+    """
+    ids = np.asarray(filtered_indices, dtype='int64')
+    sel = faiss.IDSelectorBatch(ids)
+    if isinstance(faiss_index, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(sel=sel, efSearch=HNSW_EF_SEARCH)
+    if isinstance(faiss_index, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(sel=sel, nprobe=IVF_NPROBE)
+    return faiss.SearchParameters(sel=sel)
+
+@lru_cache(maxsize=256)
+def _embed_query(query):
+    """Returns the L2-normalized embedding of a chatbot query."""
+    return embedding_model.encode(query, normalize_embeddings=True, convert_to_numpy=True).astype('float32')
+
+def get_cached_reply(query, filters=None):
+    """
+    Returns a cached chatbot reply for a semantically similar earlier query, or None.
+    A hit requires cosine similarity above QUERY_CACHE_THRESHOLD and identical metadata filters.
+    """
+    filters = filters or {}
+    query_vec = _embed_query(query)
+    # Invoices stored by another process invalidate this process's cached replies
+    _refresh_from_store()
+    with _qcache_lock:
+        if not _qcache_count:
+            return None
+        sims = _qcache_vecs[:_qcache_count] @ query_vec
+        # Only consider entries that were answered under the same filters
+        for idx in np.argsort(-sims):
+            if sims[idx] <= QUERY_CACHE_THRESHOLD:
+                return None
+            if _qcache_filters[idx] == filters:
+                return _qcache_replies[idx]
+    return None
+
+def cache_reply(query, reply, filters=None):
+    """
+    Stores a chatbot reply in the semantic cache, evicting the oldest entry when full.
+    The cache is written to disk every QUERY_CACHE_SAVE_INTERVAL replies and at exit.
+    Error replies are not cached.
+    """
+    global _qcache_count, _qcache_next, _qcache_unsaved
+    if reply.startswith("[ERROR"):
+        return
+    query_vec = _embed_query(query)
+    with _qcache_lock:
+        _qcache_vecs[_qcache_next] = query_vec
+        _qcache_filters[_qcache_next] = dict(filters or {})
+        _qcache_replies[_qcache_next] = reply
+        _qcache_next = (_qcache_next + 1) % QUERY_CACHE_SIZE
+        _qcache_count = min(_qcache_count + 1, QUERY_CACHE_SIZE)
+        _qcache_unsaved += 1
+        if _qcache_unsaved < QUERY_CACHE_SAVE_INTERVAL:
+            return
+    save_query_cache()
+
+def clear_query_cache():
+    """Drops all cached chatbot replies."""
+    global _qcache_count, _qcache_next, _qcache_unsaved, _qcache_generation
+    with _qcache_lock:
+        if not _qcache_count:
+            return
+        _qcache_generation += 1
+        _qcache_filters[:] = [None] * QUERY_CACHE_SIZE
+        _qcache_replies[:] = [None] * QUERY_CACHE_SIZE
+        _qcache_count = _qcache_next = _qcache_unsaved = 0
+        # Removing the file is enough; stale replies must not survive a restart
+        try:
+            os.remove(QUERY_CACHE_PATH)
+        except FileNotFoundError:
+            pass
+
+def save_query_cache():
+    """Writes any replies cached since the last write to disk, alongside the FAISS index."""
+    global _qcache_unsaved
+    with _qcache_lock:
+        if not _qcache_unsaved:
+            return
+        # Snapshot in oldest-first order; the pickle is written after releasing the lock
+        order = np.roll(np.arange(_qcache_count), -_qcache_next if _qcache_count == QUERY_CACHE_SIZE else 0)
+        snapshot = (
+            len(metadata_list),  # Replies are cleared on every insert, so they match the current store
+            _qcache_vecs[order],
+            [_qcache_filters[i] for i in order],
+            [_qcache_replies[i] for i in order],
+        )
+        generation = _qcache_generation
+        _qcache_unsaved = 0
+    tmp_path = f"{QUERY_CACHE_PATH}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(snapshot, f)
+    with _qcache_lock:
+        if generation == _qcache_generation:
+            os.replace(tmp_path, QUERY_CACHE_PATH)
+            return
+    os.remove(tmp_path)
+
+atexit.register(save_query_cache)
+
+# Status keywords for matching
+STATUS_KEYWORDS = {
+    "declined": "Declined",
+    "reimbursed": "Fully Reimbursed",
+    "partial": "Partially Reimbursed",
+    "partially reimbursed": "Partially Reimbursed",
+    "fully reimbursed": "Fully Reimbursed"
+}
+# All status keywords in one alternation, longest first so the most specific phrase wins at a position
+_STATUS_RE = re.compile("|".join(re.escape(k) for k in sorted(STATUS_KEYWORDS, key=len, reverse=True)))
+# Simple employee name extraction (look for 'for <name>' or 'by <name>')
+_NAME_RE = re.compile(r"(?:for|by) ([A-Z][a-z]+(?: [A-Z][a-z]+)*)")
+# Simple date extraction (YYYY-MM-DD or YYYY/MM/DD)
+_DATE_RE = re.compile(r"(\d{4}[-/]\d{2}[-/]\d{2})")
 
 def extract_metadata_filters(query):
     """
@@ -90,24 +560,14 @@ def extract_metadata_filters(query):
     Returns a dict with keys: status, employee_name, date (if found).
     """
     filters = {}
-    # Status keywords for matching
-    status_keywords = {
-        "declined": "Declined",
-        "reimbursed": "Fully Reimbursed",
-        "partial": "Partially Reimbursed",
-        "partially reimbursed": "Partially Reimbursed",
-        "fully reimbursed": "Fully Reimbursed"
-    }
-    for k, v in status_keywords.items():
-        if k in query.lower():
-            filters["status"] = v
-            break
-    # Simple employee name extraction (look for 'for <name>' or 'by <name>')
-    name_match = re.search(r"(?:for|by) ([A-Z][a-z]+(?: [A-Z][a-z]+)*)", query)
+    # One scan classifies the status: the leftmost (then longest) keyword in the query
+    status_match = _STATUS_RE.search(query.lower())
+    if status_match:
+        filters["status"] = STATUS_KEYWORDS[status_match.group(0)]
+    name_match = _NAME_RE.search(query)
     if name_match:
         filters["employee_name"] = name_match.group(1)
-    # Simple date extraction (YYYY-MM-DD or YYYY/MM/DD)
-    date_match = re.search(r"(\d{4}[-/]\d{2}[-/]\d{2})", query)
+    date_match = _DATE_RE.search(query)
     if date_match:
         filters["date"] = date_match.group(1)
-    return filters 
\ No newline at end of file
+    return filters